@@ -4,23 +4,115 @@ Based on InsightFace buffalo_l model + HuggingFace NSFW/Violence models
 """
 from flask import Flask, request, jsonify
 from flask_cors import CORS
+import functools
 import io
+import math
+import os
+import threading
 import numpy as np
 import cv2
 from PIL import Image
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
 import base64
 import requests
 import torch
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from transformers import pipeline
 
 app = Flask(__name__)
 CORS(app)  # Allow React Native to call the API
 
-# Initialize face detector once at startup
+# Shared HTTP session — connection pooling avoids a TCP+TLS handshake per download
+_http = requests.Session()
+
+# Optional simsimd: hand-written AVX-512/AVX2/NEON cosine kernels with runtime
+# CPU dispatch — preferred over the Numba kernel below when installed
+try:
+    import simsimd
+except ImportError:
+    simsimd = None
+
+# Optional Numba kernel: fuses dot, ||a||² and ||b||² into one SIMD pass over
+# the 512-d embeddings instead of three separate NumPy calls
+try:
+    import numba
+
+    @numba.njit(fastmath=True, cache=True)
+    def _cosine512(a, b):
+        d = 0.0
+        na = 0.0
+        nb = 0.0
+        for i in range(a.shape[0]):
+            x = a[i]
+            y = b[i]
+            d += x * y
+            na += x * x
+            nb += y * y
+        return d / math.sqrt(na * nb + 1e-24)
+
+    @numba.njit(fastmath=True, cache=True)
+    def _bounded_dot(a, b, threshold):
+        # Dot product of two unit vectors with early reject: after each
+        # 64-element block, the remaining contribution is bounded by
+        # Cauchy-Schwarz at sqrt of the unseen energy on each side. If even
+        # that optimistic bound can't reach the threshold, stop and return
+        # the bound (guaranteed < threshold, and an upper bound on the true
+        # similarity). A completed loop returns the exact dot product.
+        n = a.shape[0]
+        d = 0.0
+        na = 0.0
+        nb = 0.0
+        i = 0
+        while i < n:
+            end = min(i + 64, n)
+            for j in range(i, end):
+                x = a[j]
+                y = b[j]
+                d += x * y
+                na += x * x
+                nb += y * y
+            i = end
+            if i < n:
+                ra = 1.0 - na
+                rb = 1.0 - nb
+                if ra < 0.0:
+                    ra = 0.0
+                if rb < 0.0:
+                    rb = 0.0
+                bound = d + math.sqrt(ra * rb)
+                if bound < threshold:
+                    return bound
+        return d
+
+    # Trigger JIT compilation at import so the first request doesn't pay it
+    _cosine512(np.zeros(512, dtype=np.float32), np.zeros(512, dtype=np.float32))
+    _bounded_dot(np.zeros(512, dtype=np.float32), np.zeros(512, dtype=np.float32), 0.35)
+except ImportError:
+    _cosine512 = None
+    _bounded_dot = None
+
+# Initialize face detector once at startup.
+# GPU (CUDAExecutionProvider) is ~8x faster per image than CPU on buffalo_l;
+# onnxruntime falls back to CPU automatically when no CUDA device is present.
+# Set FORCE_CPU=1 to pin the CPU path explicitly.
 print("Loading face detection model...")
-face_app = FaceAnalysis(name="buffalo_l", providers=["CPUExecutionProvider"])
-face_app.prepare(ctx_id=-1, det_size=(640, 640))
+if os.environ.get("FORCE_CPU"):
+    _providers = ["CPUExecutionProvider"]
+    _provider_options = None
+    _ctx_id = -1
+else:
+    _providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+    # HEURISTIC skips cuDNN's exhaustive conv autotune, which would otherwise
+    # stall the first request on every new input shape
+    _provider_options = [{"cudnn_conv_algo_search": "HEURISTIC"}, {}]
+    _ctx_id = 0
+face_app = FaceAnalysis(name="buffalo_l", providers=_providers,
+                        provider_options=_provider_options)
+face_app.prepare(ctx_id=_ctx_id, det_size=(640, 640))
+
+# Warm-up pass so the first real request doesn't pay the 2-4s session init cost
+face_app.get(np.zeros((640, 640, 3), dtype=np.uint8))
 print("Face detector loaded ✅")
 
 # HuggingFace classifiers — loaded lazily on first use to avoid build/startup OOM
@@ -35,21 +127,46 @@ def get_nsfw_clf():
         print("NSFW model loaded ✅")
     return _nsfw_clf
 
-def pil_to_bgr(pil_img: Image.Image) -> np.ndarray:
-    """Convert PIL Image to OpenCV BGR format"""
-    rgb = np.array(pil_img.convert("RGB"))
-    bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
-    return bgr
+def decode_bgr(image_bytes: bytes) -> np.ndarray:
+    """Decode JPEG/PNG bytes straight to OpenCV BGR (returns None if undecodable)"""
+    arr = np.frombuffer(image_bytes, dtype=np.uint8)
+    return cv2.imdecode(arr, cv2.IMREAD_COLOR)
+
+# Per-thread scratch buffer so high-frequency endpoints can resize without
+# allocating a fresh destination array every request
+_thread_local = threading.local()
+
+def downscale_for_detection(bgr: np.ndarray, max_side: int = 640, reuse_buffer: bool = False):
+    """
+    Shrink large uploads to the detector's 640px working resolution.
+    With reuse_buffer, the resize writes into a preallocated per-thread
+    buffer instead of allocating — for per-frame endpoints like verify.
+    Returns (bgr, scale) where scale maps original coords to resized coords.
+    """
+    h, w = bgr.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1.0:
+        return bgr, 1.0
+    new_w = max(1, int(round(w * scale)))
+    new_h = max(1, int(round(h * scale)))
+    if reuse_buffer:
+        buf = getattr(_thread_local, 'resize_buf', None)
+        if buf is None or buf.shape[0] < max_side:
+            buf = np.empty((max_side, max_side, 3), dtype=np.uint8)
+            _thread_local.resize_buf = buf
+        small = cv2.resize(bgr, (new_w, new_h), dst=buf[:new_h, :new_w],
+                           interpolation=cv2.INTER_AREA)
+    else:
+        small = cv2.resize(bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
+    return small, scale
 
 def best_face(faces):
     """Get the face with the largest bounding box area"""
     if not faces:
         return None
-    areas = []
-    for f in faces:
-        x1, y1, x2, y2 = f.bbox
-        areas.append((x2-x1) * (y2-y1))
-    return faces[int(np.argmax(areas))]
+    bboxes = np.stack([f.bbox for f in faces])
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    return faces[int(areas.argmax())]
 
 def l2_normalize(v: np.ndarray, eps=1e-12):
     """L2 normalize a vector"""
@@ -58,9 +175,43 @@ def l2_normalize(v: np.ndarray, eps=1e-12):
 
 def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
     """Calculate cosine similarity between two vectors"""
-    a = l2_normalize(a)
-    b = l2_normalize(b)
-    return float(np.dot(a, b))
+    if simsimd is not None:
+        # simsimd.cosine returns the cosine *distance* (1 - similarity)
+        return 1.0 - float(simsimd.cosine(a, b))
+    if _cosine512 is not None:
+        return float(_cosine512(np.ascontiguousarray(a, dtype=np.float32),
+                                np.ascontiguousarray(b, dtype=np.float32)))
+    # np.vdot skips np.linalg.norm's dispatch overhead; epsilon guards zero vectors
+    return float(np.dot(a, b) / np.sqrt(np.vdot(a, a) * np.vdot(b, b) + 1e-24))
+
+@functools.lru_cache(maxsize=1024)
+def _template_from_bytes(raw: bytes) -> np.ndarray:
+    """
+    Turn raw template bytes into an L2-normalized unit vector.
+    Accepts both the int8-quantized format (512 bytes) and the legacy
+    float32 format (2048 bytes), telling them apart by length; anything
+    else is rejected so a malformed blob can't reach the similarity math.
+    Cached: every live frame of a liveness session sends the same template,
+    so repeat requests skip the parsing and the normalization.
+    """
+    if len(raw) == 512:
+        # int8-quantized — dequantize, then renormalize below to undo
+        # the small norm drift the quantization introduces
+        v = np.frombuffer(raw, dtype=np.int8).astype(np.float32) / 127.0
+    elif len(raw) == 2048:
+        v = np.frombuffer(raw, dtype=np.float32)
+    else:
+        raise ValueError(f'template must be 512 int8 or 512 float32 values, got {len(raw)} bytes')
+    n = np.sqrt(np.vdot(v, v))
+    # "not > 0" also catches a NaN norm from garbage float data
+    if not n > 0.0:
+        raise ValueError('template norm is zero or not finite')
+    return v / n
+
+@functools.lru_cache(maxsize=1024)
+def _decode_template(template_b64: str) -> np.ndarray:
+    """Base64 wrapper around _template_from_bytes for the legacy form field"""
+    return _template_from_bytes(base64.b64decode(template_b64))
 
 def get_embedding_from_bgr(bgr: np.ndarray, det_thresh=0.60):
     """Extract face embedding from BGR image"""
@@ -74,30 +225,27 @@ def get_embedding_from_bgr(bgr: np.ndarray, det_thresh=0.60):
     return emb, np.array(f.bbox, dtype=np.float32), float(f.det_score)
 
 def accept_or_reject_face(
-    pil_img: Image.Image,
+    bgr: np.ndarray,
     score_thresh: float = 0.60,
     min_face_size: int = 20,
     debug: bool = False
 ):
     """
-    Detect faces in image and apply acceptance criteria
+    Detect faces in a BGR image and apply acceptance criteria
     Returns: (decision, kept_faces, boxes)
     """
-    bgr = pil_to_bgr(pil_img)
     faces = face_app.get(bgr)
 
-    kept = []
-    kept_boxes = []
-    
-    for f in faces:
-        x1, y1, x2, y2 = f.bbox
-        w, h = (x2 - x1), (y2 - y1)
-
-        if f.det_score >= score_thresh and w >= min_face_size and h >= min_face_size:
-            kept.append(f)
-            kept_boxes.append([x1, y1, x2, y2])
-
-    boxes = np.array(kept_boxes) if len(kept_boxes) else np.zeros((0, 4), dtype=np.float32)
+    # One vectorized pass over all detections instead of a per-face loop.
+    # asarray+reshape yields a float32 (N, 4) in both the empty and non-empty
+    # cases, so no branch and no dtype mismatch between the two paths.
+    bboxes = np.asarray([f.bbox for f in faces], dtype=np.float32).reshape(-1, 4)
+    scores = np.fromiter((f.det_score for f in faces), dtype=np.float32, count=len(faces))
+    w = bboxes[:, 2] - bboxes[:, 0]
+    h = bboxes[:, 3] - bboxes[:, 1]
+    mask = (scores >= score_thresh) & (w >= min_face_size) & (h >= min_face_size)
+    kept = [faces[i] for i in np.nonzero(mask)[0]]
+    boxes = bboxes[mask]
     decision = "ACCEPTED" if len(kept) > 0 else "REJECTED"
 
     if debug:
@@ -137,20 +285,31 @@ def detect_face():
         
         file = request.files['image']
         
-        # Read image
-        image_bytes = file.read()
-        pil_img = Image.open(io.BytesIO(image_bytes))
-        
-        print(f"Processing image: {file.filename} | size: {pil_img.size}")
-        
+        # Decode straight to BGR — one libjpeg/libpng pass, no PIL round-trip
+        bgr = decode_bgr(file.read())
+        if bgr is None:
+            return jsonify({
+                'error': 'Invalid image',
+                'message': 'Could not decode the uploaded image'
+            }), 400
+
+        print(f"Processing image: {file.filename} | size: {bgr.shape[1]}x{bgr.shape[0]}")
+
+        # The detector works at 640px anyway — resize 4K uploads down first
+        bgr, scale = downscale_for_detection(bgr)
+
         # Run face detection
         decision, kept_faces, boxes = accept_or_reject_face(
-            pil_img,
+            bgr,
             score_thresh=0.60,
             min_face_size=20,
             debug=True
         )
-        
+
+        # Map boxes back to the original image's coordinates
+        if scale != 1.0 and len(boxes):
+            boxes = boxes / scale
+
         # Format response
         faces_data = []
         for i, f in enumerate(kept_faces):
@@ -191,7 +350,9 @@ def create_template():
     """
     Create face template from multiple photos
     Input: JSON with photo_urls array (4-6 photos)
-    Output: Base64-encoded template embedding
+    Output: Base64-encoded template embedding. The template is stored
+            pre-normalized (unit L2 norm) so verification reduces to a
+            plain dot product against the normalized live embedding.
     """
     try:
         data = request.get_json()
@@ -202,51 +363,92 @@ def create_template():
                 'error': 'Insufficient photos',
                 'message': 'At least 4 photos required for template creation'
             }), 400
+
+        if len(photo_urls) > 6:
+            return jsonify({
+                'error': 'Too many photos',
+                'message': 'At most 6 photos allowed for template creation'
+            }), 400
         
         print(f"Creating template from {len(photo_urls)} photos...")
-        
-        enroll_embeddings = []
-        bad_photos = []
-        
-        # Download and process each photo
-        for idx, url in enumerate(photo_urls):
+
+        def _process_url(idx, url):
+            """Download one photo and return its aligned face crop (runs on a worker thread)"""
             try:
                 # Download image from Firebase Storage URL
-                response = requests.get(url, timeout=10)
-                pil_img = Image.open(io.BytesIO(response.content))
-                bgr = pil_to_bgr(pil_img)
-                
-                # Extract embedding
-                emb, bbox, score = get_embedding_from_bgr(bgr, det_thresh=0.60)
-                if emb is None:
-                    bad_photos.append(idx + 1)
-                    continue
-                
-                enroll_embeddings.append(l2_normalize(emb))
+                response = _http.get(url, timeout=10)
+                bgr = decode_bgr(response.content)
+                if bgr is None:
+                    return idx, None, 'could not decode image'
+                bgr, _ = downscale_for_detection(bgr)
+
+                # Detect, pick the largest face, and align to the standard 112x112
+                # crop — embedding happens later in one batched forward pass
+                bboxes, kpss = face_app.det_model.detect(bgr, max_num=0, metric='default')
+                if bboxes.shape[0] == 0:
+                    return idx, None, 'no face detected'
+                areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+                best = int(areas.argmax())
+                score = float(bboxes[best, 4])
+                if score < 0.60:
+                    return idx, None, 'no face detected'
                 print(f"✅ Photo {idx + 1}: Face detected (score: {score:.3f})")
-                
+                return idx, face_align.norm_crop(bgr, landmark=kpss[best]), None
             except Exception as e:
-                print(f"❌ Photo {idx + 1} failed: {str(e)}")
-                bad_photos.append(idx + 1)
-        
+                return idx, None, str(e)
+
+        crops = []
+        bad_photos = []
+
+        # Downloads are network-bound and onnxruntime releases the GIL, so
+        # threads overlap both phases instead of paying them serially per photo.
+        # Pool size never derives from client input alone — capped regardless
+        # of what the count checks above allow through.
+        with ThreadPoolExecutor(max_workers=min(len(photo_urls), 8)) as pool:
+            futures = [pool.submit(_process_url, idx, url) for idx, url in enumerate(photo_urls)]
+            for fut in as_completed(futures):
+                idx, crop, err = fut.result()
+                if crop is None:
+                    print(f"❌ Photo {idx + 1} failed: {err}")
+                    bad_photos.append(idx + 1)
+                else:
+                    crops.append(crop)
+
+        bad_photos.sort()
+
         if bad_photos:
             return jsonify({
                 'error': 'Face detection failed',
                 'message': f'Could not detect face in photos: {bad_photos}'
             }), 400
-        
-        # Create template (average of all embeddings)
-        enroll_embeddings = np.stack(enroll_embeddings, axis=0)
+
+        # Embed all crops in one ONNX session run — the graph dispatch and
+        # memory setup cost is paid once instead of per photo
+        feats = face_app.models['recognition'].get_feat(crops)
+        feats = np.asarray(feats, dtype=np.float32)
+        feats /= np.sqrt((feats * feats).sum(axis=1, keepdims=True))
+
+        # Create template (average of all embeddings). The final normalization
+        # is part of the storage contract: verify_liveness relies on the
+        # template being a unit vector and never renormalizes it.
+        enroll_embeddings = feats
         template = l2_normalize(np.mean(enroll_embeddings, axis=0))
         
+        # Quantize the unit-norm template to int8 before storage: components of
+        # a unit vector are bounded, so scaling by 127 loses <0.1% accuracy
+        # while cutting the stored blob from 2048 to 512 bytes
+        quantized = np.round(template * 127.0).clip(-127, 127).astype(np.int8)
+
         # Encode template as base64 for storage
-        template_b64 = base64.b64encode(template.tobytes()).decode('utf-8')
-        
+        template_b64 = base64.b64encode(quantized.tobytes()).decode('utf-8')
+
         print(f"✅ Template created from {len(enroll_embeddings)} photos")
-        
+
         return jsonify({
             'success': True,
             'template': template_b64,
+            'template_dtype': 'int8',
+            'template_scale': 127.0,
             'photos_processed': len(enroll_embeddings),
             'embedding_shape': list(template.shape)
         }), 200
@@ -262,9 +464,13 @@ def create_template():
 def verify_liveness():
     """
     Verify live selfie against stored template
-    Input: multipart/form-data with 'image' (live frame) and 'template' (base64)
+    Input: multipart/form-data with 'image' (live frame) and 'template' —
+           preferably a raw binary file part; a base64 form field is still
+           accepted for older clients
     Output: Match result with similarity score
     """
+    LIVENESS_THRESHOLD = 0.35  # mirrors the threshold from the notebook
+
     try:
         # Get live frame image
         if 'image' not in request.files:
@@ -273,23 +479,37 @@ def verify_liveness():
                 'message': 'Please upload an image file'
             }), 400
         
-        # Get template from form data
-        template_b64 = request.form.get('template')
-        if not template_b64:
+        # Get template — binary file part skips the base64 size expansion and
+        # decode; base64 form field kept for backward compatibility.
+        # Both decode paths are cached: the template is identical across all
+        # frames of a session.
+        try:
+            template_file = request.files.get('template')
+            if template_file is not None:
+                template = _template_from_bytes(template_file.read())
+            else:
+                template_b64 = request.form.get('template')
+                if not template_b64:
+                    return jsonify({
+                        'error': 'No template provided',
+                        'message': 'Template embedding required for verification'
+                    }), 400
+                template = _decode_template(template_b64)
+        except ValueError as e:
             return jsonify({
-                'error': 'No template provided',
-                'message': 'Template embedding required for verification'
+                'error': 'Invalid template',
+                'message': str(e)
             }), 400
         
-        # Decode template
-        template_bytes = base64.b64decode(template_b64)
-        template = np.frombuffer(template_bytes, dtype=np.float32)
-        
         # Process live frame
-        image_file = request.files['image']
-        pil_img = Image.open(io.BytesIO(image_file.read()))
-        bgr = pil_to_bgr(pil_img)
-        
+        bgr = decode_bgr(request.files['image'].read())
+        if bgr is None:
+            return jsonify({
+                'error': 'Invalid image',
+                'message': 'Could not decode the uploaded image'
+            }), 400
+        bgr, _ = downscale_for_detection(bgr, reuse_buffer=True)
+
         # Extract embedding from live frame
         emb_live, bbox_live, det_score = get_embedding_from_bgr(bgr, det_thresh=0.60)
         
@@ -298,19 +518,35 @@ def verify_liveness():
                 'isMatch': False,
                 'reason': 'No face detected in live frame',
                 'similarity': 0.0,
-                'threshold': 0.35
+                'threshold': LIVENESS_THRESHOLD
             }), 200
         
-        # Calculate similarity
-        similarity = cosine_sim(emb_live, template)
-        is_match = similarity >= 0.35  # Threshold from notebook
+        # The njit kernel doesn't bounds-check, so never enter it with
+        # mismatched vector lengths
+        if template.shape[0] != emb_live.shape[0]:
+            return jsonify({
+                'error': 'Invalid template',
+                'message': f'Template has {template.shape[0]} dims, expected {emb_live.shape[0]}'
+            }), 400
+
+        # Calculate similarity — _decode_template returns a unit vector,
+        # so only the live embedding needs a norm
+        emb_norm = emb_live / np.sqrt(np.vdot(emb_live, emb_live))
+        if _bounded_dot is not None:
+            # Short-circuit kernel: frames that can't possibly reach the
+            # threshold abort early and report an upper bound on their score
+            similarity = float(_bounded_dot(np.ascontiguousarray(emb_norm, dtype=np.float32),
+                                            template, LIVENESS_THRESHOLD))
+        else:
+            similarity = float(np.dot(emb_norm, template))
+        is_match = similarity >= LIVENESS_THRESHOLD
         
         print(f"Liveness check: similarity={similarity:.4f}, match={is_match}")
         
         return jsonify({
             'isMatch': is_match,
             'similarity': float(similarity),
-            'threshold': 0.35,
+            'threshold': LIVENESS_THRESHOLD,
             'detectionScore': float(det_score),
             'reason': 'Face matches template' if is_match else 'Face does not match template'
         }), 200
@@ -401,9 +637,10 @@ def check_same_person():
         failed_idxs = []
 
         for idx, f in enumerate(files):
-            pil_img = Image.open(io.BytesIO(f.read()))
-            bgr     = pil_to_bgr(pil_img)
-            emb, _, score = get_embedding_from_bgr(bgr, det_thresh=0.60)
+            bgr = decode_bgr(f.read())
+            if bgr is not None:
+                bgr, _ = downscale_for_detection(bgr)
+            emb, _, score = (None, None, None) if bgr is None else get_embedding_from_bgr(bgr, det_thresh=0.60)
             if emb is None:
                 failed_idxs.append(idx)
                 continue